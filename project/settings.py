@@ -79,6 +79,11 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # This is Django's default for SQLite, but spell it out: the tests are dominated by
+        # per-test transaction setup and rollback, which must not hit the disk.
+        'TEST': {
+            'NAME': ':memory:',
+        },
     }
 }
 
@@ -21,26 +21,52 @@
 # OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+from functools import lru_cache
+from weakref import WeakKeyDictionary
+
+from django.db.models import Case, Count, When
 import graphene
 from graphene import ObjectType, relay
 from graphene_django import DjangoObjectType
-from graphene_django.filter import DjangoFilterConnectionField
-import graphql_relay
+from graphql.language.ast import Field
+from graphql_relay import from_global_id, to_global_id
+from graphql_relay.utils import base64, unbase64
 
 from .models import TodoModel
 
 
+# to_global_id() is pure, and the same few Todo ids get encoded over and over (every list
+# query, every mutation payload), so remember the results.
+cached_to_global_id = lru_cache(maxsize=4096)(to_global_id)
+
+
+class Node(relay.Node):
+    # the Relay Node interface, but encoding global ids with cached_to_global_id()
+    class Meta:
+        name = 'Node'
+        description = relay.Node._meta.description
+
+    @classmethod
+    def to_global_id(cls, type, id):
+        return cached_to_global_id(type, id)
+
+
 class Todo(DjangoObjectType):
     class Meta:
         model = TodoModel
-        filter_fields = {
-            'text': ['exact', 'icontains', 'istartswith'],
-            'complete': ['exact'],
-        }
-        interfaces = (relay.Node, )
+        interfaces = (Node, )
         use_connection = False
 
 
+# The TodoModel fields needed to resolve each Todo node field
+TODO_FIELD_COLUMNS = {
+    '__typename': (),
+    'id': ('pk', ),
+    'text': ('text', ),
+    'complete': ('complete', ),
+}
+
+
 class TodoConnection(relay.Connection):
     class Meta:
         node = Todo
@@ -50,24 +76,142 @@ class TodoConnection(relay.Connection):
         """Input field for 'todos' query on User."""
         return { 'status': graphene.String('any') }
 
+    @staticmethod
+    def get_todo_only_fields(info):
+        """Return the TodoModel fields needed for the Todo nodes selected in a 'todos' query, for
+        use with QuerySet.only(). Returns None if they can't be determined without expanding
+        fragments, or if an unknown field is selected, in which case whole rows should be fetched.
+        """
+        def subselections(selections, name):
+            result = []
+            for selection in selections:
+                if not isinstance(selection, Field):
+                    return None  # a fragment
+                if selection.name.value == name and selection.selection_set:
+                    result.extend(selection.selection_set.selections)
+            return result
+
+        columns = {'pk'}
+        for field_ast in info.field_asts:
+            edges = subselections(field_ast.selection_set.selections, 'edges')
+            if edges is None:
+                return None
+            nodes = subselections(edges, 'node')
+            if nodes is None:
+                return None
+            for node in nodes:
+                if not isinstance(node, Field):
+                    return None
+                needed = TODO_FIELD_COLUMNS.get(node.name.value)
+                if needed is None:
+                    return None
+                columns.update(needed)
+        return columns
+
     def resolve_todos(self, info, **args):
-        """Resolver for 'todos' query on User. This has a 'status' field for filtering the Todos.
-        Because 'status' is not a standard model field name, DjangoFilterConnectionField can't be
-        used.
+        """Resolver for 'todos' query on User. This has a 'status' field for filtering the Todos,
+        which may be 'any', 'active' or 'completed'; the filter is applied in SQL. Because 'status'
+        is not a standard model field name, DjangoFilterConnectionField can't be used.
         """
         qs = TodoModel.objects.all()
         status = args.get('status', None)
-        if status:
-            if status == 'completed':
-                qs = qs.filter(complete=True)
+        if status == 'completed':
+            qs = qs.filter(complete=True)
+        elif status == 'active':
+            qs = qs.filter(complete=False)
+        # don't fetch the (unbounded) text column if only e.g. the ids were asked for
+        only = TodoConnection.get_todo_only_fields(info)
+        if only is not None:
+            qs = qs.only(*only)
         return qs
 
 
+TodoEdge = TodoConnection.Edge
+
+
+def is_valid_todo_pk(pk):
+    """Return whether `pk` could be a TodoModel pk, i.e. fits in an SQLite/Postgres bigint. (Larger
+    values can't exist, and would make the database driver raise on lookup.)
+    """
+    return -2**63 <= pk < 2**63
+
+
+def todo_cursor(pk):
+    """Return the Relay cursor for the Todo with primary key `pk`."""
+    return base64('todo:{}'.format(pk))
+
+
+def todo_pk_from_cursor(cursor):
+    """Return the Todo pk from a todo_cursor(), raising an Exception if `cursor` isn't one."""
+    try:
+        prefix, pk = unbase64(cursor).split(':', 1)
+        pk = int(pk)
+    except ValueError:
+        prefix = None
+    if prefix != 'todo' or not is_valid_todo_pk(pk):
+        raise Exception("received invalid Todo cursor '{}'".format(cursor))
+    return pk
+
+
+class TodoConnectionField(relay.ConnectionField):
+    """A ConnectionField for TodoConnection that paginates in SQL. Its cursors hold the todo pk
+    rather than an offset into the list, so 'after' and 'before' become 'WHERE id > ...' and
+    'WHERE id < ...', and 'first' and 'last' become LIMITs. That needs no COUNT or OFFSET, and
+    cursors stay valid when earlier todos are added or removed.
+    """
+    @classmethod
+    def resolve_connection(cls, connection_type, args, resolved):
+        first = args.get('first')
+        last = args.get('last')
+        if (first is not None and first < 0) or (last is not None and last < 0):
+            raise Exception("'first' and 'last' must not be negative")
+        qs = resolved.order_by('pk')
+        if args.get('after') is not None:
+            qs = qs.filter(pk__gt=todo_pk_from_cursor(args['after']))
+        if args.get('before') is not None:
+            qs = qs.filter(pk__lt=todo_pk_from_cursor(args['before']))
+
+        # Fetch one extra todo to find out whether there is another page.
+        has_next_page = has_previous_page = False
+        if last is None:
+            todos = list(qs if first is None else qs[:first + 1])
+        elif first is None:
+            todos = list(qs.reverse()[:last + 1])
+            todos.reverse()
+            if len(todos) > last:
+                has_previous_page = True
+                todos = todos[1:]
+        else:  # both 'first' and 'last', which Relay discourages
+            todos = list(qs[:first + 1])
+        if first is not None and len(todos) > first:
+            has_next_page = True
+            todos = todos[:first]
+        if first is not None and last is not None and len(todos) > last:
+            has_previous_page = True
+            todos = todos[len(todos) - last:]
+
+        edges = [connection_type.Edge(node=todo, cursor=todo_cursor(todo.pk)) for todo in todos]
+        return connection_type(
+            edges=edges,
+            page_info=relay.PageInfo(
+                start_cursor=edges[0].cursor if edges else None,
+                end_cursor=edges[-1].cursor if edges else None,
+                has_previous_page=has_previous_page,
+                has_next_page=has_next_page,
+            )
+        )
+
+
+# The per-request Todo counts cache of User.get_todo_counts(), held outside the context
+# object (which may not take attributes) and dropped along with it.
+todo_counts_by_context = WeakKeyDictionary()
+
+
 class User(ObjectType):
     class Meta:
-        interfaces = (relay.Node, )
+        interfaces = (Node, )
 
-    todos = relay.ConnectionField(
+    todos = TodoConnectionField(
         TodoConnection,
         resolver=TodoConnection.resolve_todos,
         **TodoConnection.get_todos_input_fields()
@@ -75,27 +219,75 @@ class User(ObjectType):
     total_count = graphene.Int()
     completed_count = graphene.Int()
 
-    instance = None # a lazily-initialized singleton for get_node()
-
     @classmethod
     def get_node(cls, info, id):
-        if cls.instance is None:
-            cls.instance = User()
-        return cls.instance
+        return VIEWER
+
+    @staticmethod
+    def get_todo_counts(info):
+        """Return the per-request cache of Todo counts, a dict which may hold 'total' and
+        'completed'. It is keyed on the request context so that sibling 'totalCount' and
+        'completedCount' resolvers can share it. A context that can't be weakly referenced or
+        hashed (None, or a plain dict) gets a fresh, unshared dict, i.e. no caching.
+        """
+        try:
+            return todo_counts_by_context.setdefault(info.context, {})
+        except TypeError:
+            return {}
+
+    @staticmethod
+    def get_todo_count(info, name):
+        """Return the 'total' or 'completed' Todo count. Both are fetched with a single aggregate
+        query the first time either is needed in a request.
+        """
+        counts = User.get_todo_counts(info)
+        if name not in counts:
+            # Django 1.11 has no aggregate filter=, so count the non-NULLs of a CASE instead
+            counts.update(TodoModel.objects.aggregate(
+                total=Count('pk'),
+                completed=Count(Case(When(complete=True, then=1))),
+            ))
+        return counts[name]
+
+    @staticmethod
+    def clear_todo_counts(info):
+        """Discard any cached Todo counts, for use by mutations that change them."""
+        User.get_todo_counts(info).clear()
 
     def resolve_total_count(_, info):
-        return TodoModel.objects.count()
+        return User.get_todo_count(info, 'total')
 
     def resolve_completed_count(_, info):
-        return TodoModel.objects.filter(complete=True).count()
+        return User.get_todo_count(info, 'completed')
+
+
+# User is stateless, so a single instance serves as the viewer for every request.
+VIEWER = User()
 
 
 class Query(object):
-    node = relay.Node.Field()
+    node = Node.Field()
     viewer = graphene.Field(User)
 
     def resolve_viewer(self, info):
-        return True  # no Viewer resolvers will need Viewer()
+        return VIEWER
+
+
+def todo_pk_from_global_id(id):
+    """Return the TodoModel pk from a Todo global id, raising an Exception if `id` is not a valid
+    Todo global id. (The pk isn't checked for existence.)
+    """
+    try:
+        typ, pk = from_global_id(id)
+        pk = int(pk)
+    except ValueError:
+        # improper base64 (binascii.Error), not UTF-8, no ':' separator, or non-integer pk
+        raise Exception("received invalid Todo id '{}'".format(id))
+    if typ != 'Todo':
+        raise Exception("received invalid Todo id '{}' (type '{}')".format(id, typ))
+    if not is_valid_todo_pk(pk):
+        raise Exception("received invalid Todo id '{}'".format(id))
+    return pk
 
 
 class AddTodo(relay.ClientIDMutation):
@@ -107,7 +299,7 @@ class AddTodo(relay.ClientIDMutation):
     # }
     # example variables: input: { text: "New Item!", clientMutationId: 0 }
 
-    todo_edge = graphene.Field(TodoConnection.Edge)
+    todo_edge = graphene.Field(TodoEdge)
     viewer = graphene.Field(User)
 
     class Input:
@@ -117,14 +309,9 @@ class AddTodo(relay.ClientIDMutation):
     @classmethod
     def mutate_and_get_payload(cls, root, info, **input):
         todo = TodoModel.objects.create(text=input.get('text'), complete=False)
-        count = TodoModel.objects.count()  # ick, race condition if multi-user
-        edge = TodoConnection.Edge(
-            node=todo,
-            # A graphql_relay cursor is nothing more than an index into the edge
-            # list at one particular time in the past? That's just wrong....
-            cursor=graphql_relay.connection.arrayconnection.offset_to_cursor(count - 1)
-        )
-        return AddTodo(todo_edge=edge)
+        User.clear_todo_counts(info)
+        edge = TodoEdge(node=todo, cursor=todo_cursor(todo.pk))
+        return AddTodo(todo_edge=edge, viewer=VIEWER)
 
 
 class ChangeTodoStatus(relay.ClientIDMutation):
@@ -146,15 +333,15 @@ class ChangeTodoStatus(relay.ClientIDMutation):
     def mutate_and_get_payload(cls, root, info, **input):
         id = input.get('id')
         complete = input.get('complete')
+        pk = todo_pk_from_global_id(id)
         try:
-            typ, pk = graphql_relay.from_global_id(id) # may raise if improperly encoded
-            assert typ == 'Todo', 'changeTodoStatus called with type {}'.format(typ)
-            todo = TodoModel.objects.get(pk=pk) # may raise if invalid pk
-        except:
+            todo = TodoModel.objects.get(pk=pk)
+        except TodoModel.DoesNotExist:
             raise Exception("received invalid Todo id '{}'".format(id))
         todo.complete = complete
-        todo.save()
-        return ChangeTodoStatus(todo=todo, viewer=User())
+        todo.save(update_fields=['complete'])  # don't rewrite the text
+        User.clear_todo_counts(info)
+        return ChangeTodoStatus(todo=todo, viewer=VIEWER)
 
 
 class MarkAllTodos(relay.ClientIDMutation):
@@ -175,13 +362,14 @@ class MarkAllTodos(relay.ClientIDMutation):
     def mutate_and_get_payload(cls, root, info, **input):
         complete = input.get('complete')
         # save the list of items that will be changed
-        changed = [todo for todo in TodoModel.objects.filter(complete=not complete)]
-        # bulk change them
+        changed = list(TodoModel.objects.filter(complete=not complete))
+        # bulk change them with a single UPDATE
         TodoModel.objects.filter(complete=not complete).update(complete=complete)
-        # refresh changed items to their new value (-FIX- these hopefully will
-        # come from cache; I haven't checked yet)
-        changed = list(map(lambda todo: TodoModel.objects.get(pk=todo.pk), changed))
-        return MarkAllTodos(changed_todos=changed)
+        User.clear_todo_counts(info)
+        # bring the saved items up to date without re-fetching each one
+        for todo in changed:
+            todo.complete = complete
+        return MarkAllTodos(changed_todos=changed, viewer=VIEWER)
 
 
 class RemoveCompletedTodos(relay.ClientIDMutation):
@@ -201,11 +389,12 @@ class RemoveCompletedTodos(relay.ClientIDMutation):
     @classmethod
     def mutate_and_get_payload(cls, root, info, **input):
         # save the list of items that will be deleted
-        deleted = [graphql_relay.to_global_id('Todo', todo.pk)
+        deleted = [cached_to_global_id('Todo', todo.pk)
                    for todo in TodoModel.objects.filter(complete=True)]
         # bulk delete them
         TodoModel.objects.filter(complete=True).delete()
-        return RemoveCompletedTodos(deleted_todo_ids=deleted)
+        User.clear_todo_counts(info)
+        return RemoveCompletedTodos(deleted_todo_ids=deleted, viewer=VIEWER)
 
 
 class RemoveTodo(relay.ClientIDMutation):
@@ -225,15 +414,12 @@ class RemoveTodo(relay.ClientIDMutation):
     @classmethod
     def mutate_and_get_payload(cls, root, info, **input):
         id = input.get('id')
-        try:
-            typ, pk = graphql_relay.from_global_id(id) # may raise if improperly encoded
-            assert typ == 'Todo', 'changeTodoStatus called with type {}'.format(typ)
-        except:
-            raise Exception("received invalid Todo id '{}'".format(id))
+        pk = todo_pk_from_global_id(id)
         count, _ = TodoModel.objects.filter(pk=pk).delete()
+        User.clear_todo_counts(info)
         if count == 0:
             id = None
-        return RemoveTodo(deleted_todo_id=id)
+        return RemoveTodo(deleted_todo_id=id, viewer=VIEWER)
 
 
 class RenameTodo(relay.ClientIDMutation):
@@ -253,14 +439,13 @@ class RenameTodo(relay.ClientIDMutation):
     def mutate_and_get_payload(cls, root, info, **input):
         id = input.get('id')
         text = input.get('text')
+        pk = todo_pk_from_global_id(id)
         try:
-            typ, pk = graphql_relay.from_global_id(id)
-            assert typ == 'Todo', 'renameTodo called with type {}'.format(typ)
             todo = TodoModel.objects.get(pk=pk)
-        except:
+        except TodoModel.DoesNotExist:
             raise Exception("received invalid Todo id '{}'".format(id))
         todo.text = text
-        todo.save()
+        todo.save(update_fields=['text'])
         return RenameTodo(todo=todo)
 
 
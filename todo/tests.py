@@ -22,19 +22,51 @@
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import traceback
+import types
 import unittest
 
-from django.test import TestCase
-import graphene
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from graphql import parse
 from graphql.error import GraphQLError
+from graphql.execution import ExecutionResult, execute
+from graphql.validation import validate
 import graphql_relay
 
-from project.schema import Mutation, Query
+from project.schema import schema
 from .models import TodoModel
 
 
+# The tests all share the project schema, which is built once when project.schema is imported
+# and isn't modified by executing queries. Likewise, the query documents below are parsed once,
+# at import, and validated once, by execute_query().
+
+
 # ========== utility functions ==========
 
+validated_documents = set()  # id()s of the documents execute_query() has validated
+
+
+def execute_query(document, **kwargs):
+    """Execute a parsed query document against the schema, returning the ExecutionResult. The
+    document is validated the first time it is executed; after that it goes straight to
+    graphql-core's execute(), skipping the parse and validate steps of schema.execute().
+    """
+    if id(document) not in validated_documents:
+        errors = validate(schema, document)
+        if errors:
+            return ExecutionResult(errors=errors, invalid=True)
+        validated_documents.add(id(document))
+    return execute(schema, document, **kwargs)
+
+
+class RequestContext(object):
+    """A stand-in for the HttpRequest that graphene_django passes as the context, for tests of the
+    per-request Todo counts cache.
+    """
+
+
 def format_graphql_errors(errors):
     """Return a string with the usual exception traceback, plus some extra fields that GraphQL
     provides.
@@ -43,517 +75,791 @@ def format_graphql_errors(errors):
         return None
     text = []
     for i, e in enumerate(errors):
-        text.append('GraphQL schema execution error [{}]:\n'.format(i))
+        text.append(f'GraphQL schema execution error [{i}]:\n')
         if isinstance(e, GraphQLError):
             for attr in ('args', 'locations', 'nodes', 'positions', 'source'):
                 if hasattr(e, attr):
                     if attr == 'source':
-                        text.append('source: {}:{}\n'
-                                    .format(e.source.name, e.source.body))
+                        text.append(f'source: {e.source.name}:{e.source.body}\n')
                     else:
-                        text.append('{}: {}\n'.format(attr, repr(getattr(e, attr))))
+                        text.append(f'{attr}: {getattr(e, attr)!r}\n')
         if isinstance(e, Exception):
-            text.append(''.join(traceback.format_exception(type(e), e, e.stack)))
+            # e.stack is the traceback of the original error; limit it so deep Django stacks
+            # don't swamp the message
+            text.extend(traceback.TracebackException(type(e), e, e.stack, limit=20).format())
         else:
             text.append(repr(e) + '\n')
     return ''.join(text)
 
 
+class LazyGraphQLErrors(object):
+    """An assertion message which formats GraphQL errors with format_graphql_errors() only when
+    needed. unittest calls str() on a message only when the assertion fails, so passing tests skip
+    the formatting entirely.
+    """
+    def __init__(self, errors):
+        self.errors = errors
+
+    def __str__(self):
+        return format_graphql_errors(self.errors) or ''
+
+
+class LazyMismatch(object):
+    """An assertion message showing the expected and actual values, repr()ed only if the assertion
+    fails (see LazyGraphQLErrors).
+    """
+    def __init__(self, expected, actual):
+        self.expected = expected
+        self.actual = actual
+
+    def __str__(self):
+        return '\n' + repr(self.expected) + '\n' + repr(self.actual)
+
+
+def freeze(mapping):
+    """Return a read-only view of `mapping`, with any dicts nested in it frozen too."""
+    return types.MappingProxyType({key: freeze(value) if isinstance(value, dict) else value
+                                   for key, value in mapping.items()})
+
+
+# the global ids of the todos from create_test_data()
+TODO1_GID = graphql_relay.to_global_id('Todo', 1)
+TODO2_GID = graphql_relay.to_global_id('Todo', 2)
+
+
 def create_test_data():
-    TodoModel.objects.create(text='Taste JavaScript', complete=True)
-    TodoModel.objects.create(text='Buy a unicorn', complete=False)
+    TodoModel.objects.bulk_create([
+        TodoModel(text='Taste JavaScript', complete=True),
+        TodoModel(text='Buy a unicorn', complete=False),
+    ])
+
+
+class TodoDataTestCase(TestCase):
+    """A TestCase with the create_test_data() todos, created once for the whole class. Each test
+    still runs in its own transaction, so changes made by one test don't leak into the next.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        create_test_data()
 
 
 # ========== GraphQL schema general tests ==========
 
-class RootTests(TestCase):
+ROOT_QUERY = parse('''
+  query RootQueryQuery {
+    __schema {
+      queryType {
+        name  # returns the type of the root query
+      }
+    }
+  }
+''')
+
+ROOT_EXPECTED = {
+    '__schema': {
+        'queryType': {
+            'name': 'Query'
+        }
+    }
+}
+
+
+class RootTests(SimpleTestCase):
     def test_root_query(self):
         """Make sure the root query is 'Query'.
 
         This test is pretty redundant, given that every other query in this file will fail if this
         is not the case, but it's a nice simple example of testing query execution.
         """
-        query = '''
-          query RootQueryQuery {
-            __schema {
-              queryType {
-                name  # returns the type of the root query
-              }
-            }
+        result = execute_query(ROOT_QUERY)
+        self.assertIsNone(result.errors, msg=LazyGraphQLErrors(result.errors))
+        self.assertEqual(result.data, ROOT_EXPECTED, msg=LazyMismatch(ROOT_EXPECTED, result.data))
+
+
+VIEWER_SCHEMA_QUERY = parse('''
+  query ViewerSchemaTest {
+    __type(name: "User") {
+      name
+      fields {
+        name
+        type {
+          name
+          kind
+          ofType {
+            name
           }
-        '''
-        expected = {
-            '__schema': {
-                'queryType': {
-                    'name': 'Query'
-                }
-            }
         }
-        schema = graphene.Schema(query=Query)
-        result = schema.execute(query)
-        self.assertIsNone(result.errors, msg=format_graphql_errors(result.errors))
-        self.assertEqual(result.data, expected, msg='\n'+repr(expected)+'\n'+repr(result.data))
+      }
+    }
+  }
+''')
+
+VIEWER_SCHEMA_EXPECTED = {
+    '__type': {
+        'name': 'User',
+        'fields': [
+            {
+                'name': 'id',
+                'type': {
+                    'name': None,
+                    'kind': 'NON_NULL',
+                    'ofType': {
+                        'name': 'ID',
+                    }
+                }
+            },
+            {
+                'name': 'todos',
+                'type': {
+                    'name': 'TodoConnection',
+                    'kind': 'OBJECT',
+                    'ofType': None,
+                }
+            },
+            {
+                'name': 'totalCount',
+                'type': {
+                    'name': 'Int',
+                    'kind': 'SCALAR',
+                    'ofType': None,
+                }
+            },
+            {
+                'name': 'completedCount',
+                'type': {
+                    'name': 'Int',
+                    'kind': 'SCALAR',
+                    'ofType': None,
+                }
+            },
+        ]
+    }
+}
 
+# the User fields test_viewer_schema checks; any others are ignored
+VIEWER_NEEDED_FIELDS = frozenset(f['name'] for f in VIEWER_SCHEMA_EXPECTED['__type']['fields'])
 
-class ViewerTests(TestCase):
+
+class ViewerTests(SimpleTestCase):
     def test_viewer_schema(self):
         """Check the 'viewer' field User type schema contains the fields we need."""
-        query = '''
-          query ViewerSchemaTest {
-            __type(name: "User") {
-              name
-              fields {
-                name
-                type {
-                  name
-                  kind
-                  ofType {
-                    name
-                  }
-                }
-              }
-            }
-          }
-        '''
-        expected = {
-            '__type': {
-                'name': 'User',
-                'fields': [
-                    {
-                        'name': 'id',
-                        'type': {
-                            'name': None,
-                            'kind': 'NON_NULL',
-                            'ofType': {
-                                'name': 'ID',
-                            }
-                        }
-                    },
-                    {
-                        'name': 'todos',
-                        'type': {
-                            'name': 'TodoConnection',
-                            'kind': 'OBJECT',
-                            'ofType': None,
-                        }
-                    },
-                    {
-                        'name': 'totalCount',
-                        'type': {
-                            'name': 'Int',
-                            'kind': 'SCALAR',
-                            'ofType': None,
-                        }
-                    },
-                    {
-                        'name': 'completedCount',
-                        'type': {
-                            'name': 'Int',
-                            'kind': 'SCALAR',
-                            'ofType': None,
-                        }
-                    },
-                ]
-            }
-        }
-        schema = graphene.Schema(query=Query)
-        result = schema.execute(query)
-        self.assertIsNone(result.errors, msg=format_graphql_errors(result.errors))
+        result = execute_query(VIEWER_SCHEMA_QUERY)
+        self.assertIsNone(result.errors, msg=LazyGraphQLErrors(result.errors))
         # Check that the fields we need are there, but don't fail on extra fields.
-        NEEDED_FIELDS = ('id', 'todos', 'totalCount', 'completedCount')
-        result.data['__type']['fields'] = list(filter(
-            lambda f: f['name'] in NEEDED_FIELDS,
-            result.data['__type']['fields']
-        ))
-        self.assertEqual(result.data, expected, msg='\n'+repr(expected)+'\n'+repr(result.data))
+        result.data['__type']['fields'] = [f for f in result.data['__type']['fields']
+                                           if f['name'] in VIEWER_NEEDED_FIELDS]
+        self.assertEqual(result.data, VIEWER_SCHEMA_EXPECTED,
+                         msg=LazyMismatch(VIEWER_SCHEMA_EXPECTED, result.data))
 
 
 # ========== Relay Node tests ==========
 
+NODE_FOR_TODO_QUERY = parse('''
+  query NodeForTodoTest($id: ID!) {
+    node(id: $id) {
+      id
+      ...on Todo {
+        text
+      }
+    }
+  }
+''')
+
+VIEWER_ID_QUERY = parse('''
+  query ViewerIdTest {
+    viewer {
+      id
+    }
+  }
+''')
+
+NODE_ID_QUERY = parse('''
+  query NodeIdTest($id: ID!) {
+    node(id: $id) {
+      id
+    }
+  }
+''')
+
+
 class RelayNodeTests(TestCase):
     """Test that model nodes can be retreived via the Relay Node interface."""
     def test_node_for_todo(self):
         todo = TodoModel.objects.create(text='Test', complete=False)
         todo_gid = graphql_relay.to_global_id('Todo', todo.pk)
-        query = '''
-          query {
-            node(id: "%s") {
-              id
-              ...on Todo {
-                text
-              }
-            }
-          }
-        ''' % todo_gid
         expected = {
           'node': {
             'id': todo_gid,
             'text': 'Test',
           }
         }
-        schema = graphene.Schema(query=Query)
-        result = schema.execute(query)
-        self.assertIsNone(result.errors, msg=format_graphql_errors(result.errors))
-        self.assertEqual(result.data, expected, msg='\n'+repr(expected)+'\n'+repr(result.data))
+        result = execute_query(NODE_FOR_TODO_QUERY, variable_values={'id': todo_gid})
+        self.assertIsNone(result.errors, msg=LazyGraphQLErrors(result.errors))
+        self.assertEqual(result.data, expected, msg=LazyMismatch(expected, result.data))
 
     def test_node_for_viewer(self):
-        query = '''
-          query {
-            viewer {
-              id
-            }
-          }
-        '''
-        schema = graphene.Schema(query=Query)
-        result = schema.execute(query)
-        self.assertIsNone(result.errors, msg=format_graphql_errors(result.errors))
+        result = execute_query(VIEWER_ID_QUERY)
+        self.assertIsNone(result.errors, msg=LazyGraphQLErrors(result.errors))
         viewer_gid = result.data['viewer']['id']
-        query = '''
-          query {
-            node(id: "%s") {
-              id
-            }
-          }
-        ''' % viewer_gid
         expected = {
           'node': {
             'id': viewer_gid,
           }
         }
-        result = schema.execute(query)
-        self.assertIsNone(result.errors, msg=format_graphql_errors(result.errors))
-        self.assertEqual(result.data, expected, msg='\n'+repr(expected)+'\n'+repr(result.data))
+        result = execute_query(NODE_ID_QUERY, variable_values={'id': viewer_gid})
+        self.assertIsNone(result.errors, msg=LazyGraphQLErrors(result.errors))
+        self.assertEqual(result.data, expected, msg=LazyMismatch(expected, result.data))
 
 
 # ========== Todo query tests ==========
 
-class TodoTests(TestCase):
-    def test_total_count(self):
-        """Test viewer totalCount field."""
-        create_test_data()
-        query = '''
-          query TotalCountTest {
-            viewer {
-              totalCount
-            }
-          }
-        '''
-        expected = {
-            'viewer': {
-                'totalCount': 2,
-            }
-        }
-        schema = graphene.Schema(query=Query)
-        result = schema.execute(query)
-        self.assertIsNone(result.errors, msg=format_graphql_errors(result.errors))
-        self.assertEqual(result.data, expected, msg='\n'+repr(expected)+'\n'+repr(result.data))
-
-    def test_completed_count(self):
-        """Test viewer completedCount field."""
-        create_test_data()
-        query = '''
-          query CompletedCountTest {
-            viewer {
-              completedCount
-            }
+TOTAL_COUNT_QUERY = parse('''
+  query TotalCountTest {
+    viewer {
+      totalCount
+    }
+  }
+''')
+
+TOTAL_COUNT_EXPECTED = {
+    'viewer': {
+        'totalCount': 2,
+    }
+}
+
+COMPLETED_COUNT_QUERY = parse('''
+  query CompletedCountTest {
+    viewer {
+      completedCount
+    }
+  }
+''')
+
+COMPLETED_COUNT_EXPECTED = {
+    'viewer': {
+        'completedCount': 1,
+    }
+}
+
+COUNTS_QUERY = parse('''
+  query CountsTest {
+    viewer {
+      totalCount
+      completedCount
+    }
+  }
+''')
+
+COUNTS_EXPECTED = {
+    'viewer': {
+        'totalCount': 2,
+        'completedCount': 1,
+    }
+}
+
+TODOS_QUERY = parse('''
+  query TodosTest {
+    viewer {
+      todos {
+        edges {
+          node {
+            text
           }
-        '''
-        expected = {
-            'viewer': {
-                'completedCount': 1,
-            }
         }
-        schema = graphene.Schema(query=Query)
-        result = schema.execute(query)
-        self.assertIsNone(result.errors, msg=format_graphql_errors(result.errors))
-        self.assertEqual(result.data, expected, msg='\n'+repr(expected)+'\n'+repr(result.data))
-
-    def test_todos(self):
-        """Test viewer todos field."""
-        create_test_data()
-        query = '''
-          query TodosTest {
-            viewer {
-              todos {
-                edges {
-                  node {
-                    text
-                  }
-                }
-              }
-            }
-          }
-        '''
-        expected = {
-            'viewer': {
-                'todos': {
-                    'edges': [
-                        {
-                            'node': {
-                                'text': 'Buy a unicorn',
-                            }
-                        },
-                        {
-                            'node': {
-                                'text': 'Taste JavaScript',
-                            }
-                        },
-                    ]
-                }
-            }
+      }
+    }
+  }
+''')
+
+TODOS_EXPECTED = {
+    'viewer': {
+        'todos': {
+            'edges': [
+                {
+                    'node': {
+                        'text': 'Taste JavaScript',
+                    }
+                },
+                {
+                    'node': {
+                        'text': 'Buy a unicorn',
+                    }
+                },
+            ]
         }
-        schema = graphene.Schema(query=Query)
-        result = schema.execute(query)
-        self.assertIsNone(result.errors, msg=format_graphql_errors(result.errors))
-        # don't depend on the ordering of the returned nodes
-        result.data['viewer']['todos']['edges'].sort(key=lambda d: d['node']['text'])
-        self.assertEqual(result.data, expected, msg='\n'+repr(expected)+'\n'+repr(result.data))
-
-    def test_todos_filter_by_completed(self):
-        """'fragment TodoListFooter_viewer on User' filters todos on 'status: "completed"' – test
-        that.
-        """
-        create_test_data()
-        query = '''
-          query CompletedTodosTest {
-            viewer {
-              todos(status: "completed") {
-                edges {
-                  node {
-                    text
-                  }
-                }
-              }
-            }
+    }
+}
+
+TODO_IDS_QUERY = parse('''
+  query TodoIdsTest {
+    viewer {
+      todos {
+        edges {
+          node {
+            id
+            complete
           }
-        '''
-        expected = {
-            'viewer': {
-                'todos': {
-                    'edges': [
-                        {
-                            'node': {
-                                'text': 'Taste JavaScript',
-                            }
-                        },
-                    ]
-                }
-            }
         }
-        schema = graphene.Schema(query=Query)
-        result = schema.execute(query)
-        self.assertIsNone(result.errors, msg=format_graphql_errors(result.errors))
-        self.assertEqual(result.data, expected, msg='\n'+repr(expected)+'\n'+repr(result.data))
-
-
-# ========== Todo mutation tests ==========
-
-class AddTodoTests(TestCase):
-    def test_add_todo(self):
-        query = '''
-          mutation AddTodoMutation($input: AddTodoInput!) {
-            addTodo(input: $input) {
-              todoEdge { cursor node { text } }
-              viewer { totalCount }
-              clientMutationId
-            }
+      }
+    }
+  }
+''')
+
+COMPLETED_TODOS_QUERY = parse('''
+  query CompletedTodosTest {
+    viewer {
+      todos(status: "completed") {
+        edges {
+          node {
+            text
           }
-        '''
-        variables = {
-            'input': {
-                'text': 'Test Todo',
-                'clientMutationId': 'give_this_back_to_me',
-            }
         }
-        expected = {
-            'addTodo': {
-                'todoEdge': {
-                    'cursor': 'YXJyYXljb25uZWN0aW9uOjA=',  # 'arrayconnection:0' in base64
+      }
+    }
+  }
+''')
+
+COMPLETED_TODOS_EXPECTED = {
+    'viewer': {
+        'todos': {
+            'edges': [
+                {
                     'node': {
-                        'text': 'Test Todo',
+                        'text': 'Taste JavaScript',
                     }
                 },
-                'viewer': {
-                    'totalCount': 1,
-                },
-                'clientMutationId': 'give_this_back_to_me',
-            }
+            ]
         }
-        schema = graphene.Schema(query=Query, mutation=Mutation)
-        result = schema.execute(query, variable_values=variables)
-        self.assertIsNone(result.errors, msg=format_graphql_errors(result.errors))
-        self.assertEqual(result.data, expected, msg='\n'+repr(expected)+'\n'+repr(result.data))
-
-
-class ChangeTodoStatusTests(TestCase):
-    def test_change_todo_status(self):
-        create_test_data()
-        query = '''
-          mutation ChangeTodoStatusMutation($input: ChangeTodoStatusInput!) {
-            changeTodoStatus(input: $input) {
-              todo { complete }
-              viewer { completedCount }
-              clientMutationId
-            }
+    }
+}
+
+ACTIVE_TODOS_QUERY = parse('''
+  query ActiveTodosTest {
+    viewer {
+      todos(status: "active") {
+        edges {
+          node {
+            text
           }
-        '''
-        variables = {
-            'input': {
-                'id': graphql_relay.to_global_id('Todo', 1),
-                'complete': False,
-                'clientMutationId': 'give_this_back_to_me',
-            }
         }
-        expected = {
-            'changeTodoStatus': {
-                'todo': {
-                    'complete': False,
-                },
-                'viewer': {
-                    'completedCount': 0,
+      }
+    }
+  }
+''')
+
+ACTIVE_TODOS_EXPECTED = {
+    'viewer': {
+        'todos': {
+            'edges': [
+                {
+                    'node': {
+                        'text': 'Buy a unicorn',
+                    }
                 },
-                'clientMutationId': 'give_this_back_to_me',
-            }
+            ]
         }
-        schema = graphene.Schema(query=Query, mutation=Mutation)
-        result = schema.execute(query, variable_values=variables)
-        self.assertIsNone(result.errors, msg=format_graphql_errors(result.errors))
-        self.assertEqual(result.data, expected, msg='\n'+repr(expected)+'\n'+repr(result.data))
-
-
-class MarkAllTodosTests(TestCase):
-    def test_mark_all_todos(self):
-        create_test_data()
-        query = '''
-          mutation MarkAllTodosMutation($input: MarkAllTodosInput!) {
-            markAllTodos(input: $input) {
-              changedTodos { id complete }
-              viewer { completedCount }
-              clientMutationId
-            }
+    }
+}
+
+TODOS_PAGE_QUERY = parse('''
+  query TodosPageTest($first: Int, $after: String, $last: Int, $before: String) {
+    viewer {
+      todos(first: $first, after: $after, last: $last, before: $before) {
+        edges {
+          cursor
+          node {
+            text
           }
-        '''
-        variables = {
-            'input': {
-                'complete': True,
-                'clientMutationId': 'give_this_back_to_me',
-            }
         }
-        expected = {
-            'markAllTodos': {
-                'changedTodos': [
-                    {
-                        'id': graphql_relay.to_global_id('Todo', 2),
-                        'complete': True,
-                    },
-                ],
-                'viewer': {
-                    'completedCount': 2,
-                },
-                'clientMutationId': 'give_this_back_to_me',
-            }
+        pageInfo {
+          hasNextPage
+          hasPreviousPage
+          startCursor
+          endCursor
         }
-        schema = graphene.Schema(query=Query, mutation=Mutation)
-        result = schema.execute(query, variable_values=variables)
-        self.assertIsNone(result.errors, msg=format_graphql_errors(result.errors))
-        self.assertEqual(result.data, expected, msg='\n'+repr(expected)+'\n'+repr(result.data))
+      }
+    }
+  }
+''')
 
 
-class RemoveCompletedTodosTests(TestCase):
-    def test_remove_todo(self):
-        create_test_data()
-        query = '''
-          mutation RemoveCompletedTodosMutation($input: RemoveCompletedTodosInput!) {
-            removeCompletedTodos(input: $input) {
-              deletedTodoIds
-              viewer { completedCount totalCount }
-              clientMutationId
-            }
-          }
-        '''
-        variables = {
-            'input': {
-                'clientMutationId': 'give_this_back_to_me',
-            },
-        }
-        expected = {
-            'removeCompletedTodos': {
-                'deletedTodoIds': [graphql_relay.to_global_id('Todo', 1)],
-                'viewer': {
-                    'completedCount': 0,
-                    'totalCount': 1,
-                },
-                'clientMutationId': 'give_this_back_to_me',
-            }
-        }
-        schema = graphene.Schema(query=Query, mutation=Mutation)
-        result = schema.execute(query, variable_values=variables)
-        self.assertIsNone(result.errors, msg=format_graphql_errors(result.errors))
-        self.assertEqual(result.data, expected, msg='\n'+repr(expected)+'\n'+repr(result.data))
+class TodoTests(TodoDataTestCase):
+    def test_viewer_fields(self):
+        """Test the viewer totalCount, completedCount and todos fields, each of which should take a
+        single query. (For todos that's one SELECT for the whole page, not one per edge.) Todos are
+        returned in creation (pk) order.
+        """
+        cases = (
+            ('totalCount', TOTAL_COUNT_QUERY, TOTAL_COUNT_EXPECTED),
+            ('completedCount', COMPLETED_COUNT_QUERY, COMPLETED_COUNT_EXPECTED),
+            ('todos', TODOS_QUERY, TODOS_EXPECTED),
+        )
+        for field, document, expected in cases:
+            with self.subTest(field=field):
+                with self.assertNumQueries(1):
+                    result = execute_query(document)
+                self.assertIsNone(result.errors, msg=LazyGraphQLErrors(result.errors))
+                self.assertEqual(result.data, expected, msg=LazyMismatch(expected, result.data))
+
+    def test_counts_share_one_query(self):
+        """Test that totalCount and completedCount are fetched with a single query per request."""
+        with self.assertNumQueries(1):
+            result = execute_query(COUNTS_QUERY, context_value=RequestContext())
+        self.assertIsNone(result.errors, msg=LazyGraphQLErrors(result.errors))
+        self.assertEqual(result.data, COUNTS_EXPECTED,
+                         msg=LazyMismatch(COUNTS_EXPECTED, result.data))
+
+    def test_counts_with_dict_context(self):
+        """Test that totalCount and completedCount resolve with a plain dict as the context, which
+        can't hold the counts cache, so each takes its own query.
+        """
+        with self.assertNumQueries(2):
+            result = execute_query(COUNTS_QUERY, context_value={})
+        self.assertIsNone(result.errors, msg=LazyGraphQLErrors(result.errors))
+        self.assertEqual(result.data, COUNTS_EXPECTED,
+                         msg=LazyMismatch(COUNTS_EXPECTED, result.data))
+
+    def test_todos_pagination(self):
+        """Test paging through viewer todos with 'first'/'after' and 'last'/'before'."""
+        def page(**variables):
+            result = execute_query(TODOS_PAGE_QUERY, variable_values=variables)
+            self.assertIsNone(result.errors, msg=LazyGraphQLErrors(result.errors))
+            todos = result.data['viewer']['todos']
+            return [edge['node']['text'] for edge in todos['edges']], todos['pageInfo']
+
+        texts, page_info = page(first=1)
+        self.assertEqual(texts, ['Taste JavaScript'])
+        self.assertTrue(page_info['hasNextPage'])
+        texts, page_info = page(first=1, after=page_info['endCursor'])
+        self.assertEqual(texts, ['Buy a unicorn'])
+        self.assertFalse(page_info['hasNextPage'])
+        texts, page_info = page(last=1)
+        self.assertEqual(texts, ['Buy a unicorn'])
+        self.assertTrue(page_info['hasPreviousPage'])
+        texts, page_info = page(last=1, before=page_info['startCursor'])
+        self.assertEqual(texts, ['Taste JavaScript'])
+        self.assertFalse(page_info['hasPreviousPage'])
+
+    def test_todos_pagination_invalid_args(self):
+        """Test that malformed and out-of-range cursors, and negative 'first'/'last', are reported
+        as errors.
+        """
+        bad_args = (
+            ({'after': 'not base64!'}, 'received invalid Todo cursor'),
+            ({'before': graphql_relay.utils.base64('todo:x')}, 'received invalid Todo cursor'),
+            ({'after': graphql_relay.utils.base64('offset:1')}, 'received invalid Todo cursor'),
+            # too large for an SQLite INTEGER
+            ({'first': 1, 'after': graphql_relay.utils.base64('todo:' + '9' * 30)},
+             'received invalid Todo cursor'),
+            ({'first': -1}, "'first' and 'last' must not be negative"),
+            ({'last': -1}, "'first' and 'last' must not be negative"),
+        )
+        for variables, message in bad_args:
+            with self.subTest(**variables):
+                result = execute_query(TODOS_PAGE_QUERY, variable_values=variables)
+                self.assertIsNotNone(result.errors)
+                self.assertIn(message, str(result.errors[0]))
+
+    def test_todos_fetches_only_selected_fields(self):
+        """Test that the todos query doesn't fetch the text column when it isn't selected."""
+        with CaptureQueriesContext(connection) as queries:
+            result = execute_query(TODO_IDS_QUERY)
+        self.assertIsNone(result.errors, msg=LazyGraphQLErrors(result.errors))
+        self.assertEqual(len(result.data['viewer']['todos']['edges']), 2)
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('"text"', queries[0]['sql'])
+
+    def test_todos_filter_by_completed(self):
+        """'fragment TodoListFooter_viewer on User' filters todos on 'status: "completed"' – test
+        that.
+        """
+        result = execute_query(COMPLETED_TODOS_QUERY)
+        self.assertIsNone(result.errors, msg=LazyGraphQLErrors(result.errors))
+        self.assertEqual(result.data, COMPLETED_TODOS_EXPECTED,
+                         msg=LazyMismatch(COMPLETED_TODOS_EXPECTED, result.data))
 
+    def test_todos_filter_by_active(self):
+        """Test filtering todos on 'status: "active"'."""
+        result = execute_query(ACTIVE_TODOS_QUERY)
+        self.assertIsNone(result.errors, msg=LazyGraphQLErrors(result.errors))
+        self.assertEqual(result.data, ACTIVE_TODOS_EXPECTED,
+                         msg=LazyMismatch(ACTIVE_TODOS_EXPECTED, result.data))
 
-class RemoveTodoTests(TestCase):
-    def test_remove_todo(self):
-        create_test_data()
-        query = '''
-          mutation RemoveTodoMutation($input: RemoveTodoInput!) {
-            removeTodo(input: $input) {
-              deletedTodoId
-              viewer { completedCount totalCount }
-              clientMutationId
-            }
-          }
-        '''
-        todo_gid = graphql_relay.to_global_id('Todo', 1)
-        variables = {
-            'input': {
-                'id': todo_gid,
-                'clientMutationId': 'give_this_back_to_me',
-            }
-        }
-        expected = {
-            'removeTodo': {
-                'deletedTodoId': todo_gid,
-                'viewer': {
-                    'completedCount': 0,
-                    'totalCount': 1,
-                },
-                'clientMutationId': 'give_this_back_to_me',
+
+# ========== Todo mutation tests ==========
+
+ADD_TODO_MUTATION = parse('''
+  mutation AddTodoMutation($input: AddTodoInput!) {
+    addTodo(input: $input) {
+      todoEdge { cursor node { text } }
+      viewer { totalCount }
+      clientMutationId
+    }
+  }
+''')
+
+ADD_TODO_VARIABLES = freeze({
+    'input': {
+        'text': 'Test Todo',
+        'clientMutationId': 'give_this_back_to_me',
+    }
+})
+
+ADD_TODO_EXPECTED = {
+    'addTodo': {
+        'todoEdge': {
+            'cursor': 'dG9kbzox',  # 'todo:1' in base64
+            'node': {
+                'text': 'Test Todo',
             }
-        }
-        schema = graphene.Schema(query=Query, mutation=Mutation)
-        result = schema.execute(query, variable_values=variables)
-        self.assertIsNone(result.errors, msg=format_graphql_errors(result.errors))
-        self.assertEqual(result.data, expected, msg='\n'+repr(expected)+'\n'+repr(result.data))
+        },
+        'viewer': {
+            'totalCount': 1,
+        },
+        'clientMutationId': 'give_this_back_to_me',
+    }
+}
 
 
-class RenameTodoTests(TestCase):
+class AddTodoTests(TestCase):
+    def test_add_todo(self):
+        # INSERT, and the count for 'totalCount'
+        with self.assertNumQueries(2):
+            result = execute_query(ADD_TODO_MUTATION, variable_values=ADD_TODO_VARIABLES,
+                                   context_value=RequestContext())
+        self.assertIsNone(result.errors, msg=LazyGraphQLErrors(result.errors))
+        self.assertEqual(result.data, ADD_TODO_EXPECTED,
+                         msg=LazyMismatch(ADD_TODO_EXPECTED, result.data))
+
+    def test_add_todo_with_dict_context(self):
+        """Test that the viewer in the payload resolves with a plain dict as the context."""
+        result = execute_query(ADD_TODO_MUTATION, variable_values=ADD_TODO_VARIABLES,
+                               context_value={})
+        self.assertIsNone(result.errors, msg=LazyGraphQLErrors(result.errors))
+        self.assertEqual(result.data, ADD_TODO_EXPECTED,
+                         msg=LazyMismatch(ADD_TODO_EXPECTED, result.data))
+
+
+CHANGE_TODO_STATUS_MUTATION = parse('''
+  mutation ChangeTodoStatusMutation($input: ChangeTodoStatusInput!) {
+    changeTodoStatus(input: $input) {
+      todo { complete }
+      viewer { completedCount }
+      clientMutationId
+    }
+  }
+''')
+
+CHANGE_TODO_STATUS_VARIABLES = freeze({
+    'input': {
+        'id': TODO1_GID,
+        'complete': False,
+        'clientMutationId': 'give_this_back_to_me',
+    }
+})
+
+CHANGE_TODO_STATUS_EXPECTED = {
+    'changeTodoStatus': {
+        'todo': {
+            'complete': False,
+        },
+        'viewer': {
+            'completedCount': 0,
+        },
+        'clientMutationId': 'give_this_back_to_me',
+    }
+}
+
+
+class ChangeTodoStatusTests(TodoDataTestCase):
+    def test_change_todo_status(self):
+        result = execute_query(CHANGE_TODO_STATUS_MUTATION,
+                               variable_values=CHANGE_TODO_STATUS_VARIABLES)
+        self.assertIsNone(result.errors, msg=LazyGraphQLErrors(result.errors))
+        self.assertEqual(result.data, CHANGE_TODO_STATUS_EXPECTED,
+                         msg=LazyMismatch(CHANGE_TODO_STATUS_EXPECTED, result.data))
+
+    def test_change_todo_status_updates_only_complete(self):
+        """Test that changing a todo's status doesn't rewrite its text column."""
+        with CaptureQueriesContext(connection) as queries:
+            result = execute_query(CHANGE_TODO_STATUS_MUTATION,
+                                   variable_values=CHANGE_TODO_STATUS_VARIABLES)
+        self.assertIsNone(result.errors, msg=LazyGraphQLErrors(result.errors))
+        updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertNotIn('"text"', updates[0])
+
+    def test_change_todo_status_invalid_id(self):
+        """Test that malformed, wrongly-typed and nonexistent Todo ids are reported as invalid."""
+        bad_ids = (
+            'not base64!',
+            graphql_relay.to_global_id('User', 1),
+            graphql_relay.to_global_id('Todo', 'x'),
+            graphql_relay.to_global_id('Todo', 99),  # no such Todo
+            graphql_relay.to_global_id('Todo', 10**30),  # too large for an SQLite INTEGER
+        )
+        for bad_id in bad_ids:
+            result = execute_query(CHANGE_TODO_STATUS_MUTATION, variable_values={
+                'input': {'id': bad_id, 'complete': True}
+            })
+            self.assertIsNotNone(result.errors, msg=bad_id)
+            self.assertIn('received invalid Todo id', str(result.errors[0]))
+
+
+MARK_ALL_TODOS_MUTATION = parse('''
+  mutation MarkAllTodosMutation($input: MarkAllTodosInput!) {
+    markAllTodos(input: $input) {
+      changedTodos { id complete }
+      viewer { completedCount }
+      clientMutationId
+    }
+  }
+''')
+
+MARK_ALL_TODOS_VARIABLES = freeze({
+    'input': {
+        'complete': True,
+        'clientMutationId': 'give_this_back_to_me',
+    }
+})
+
+MARK_ALL_TODOS_EXPECTED = {
+    'markAllTodos': {
+        'changedTodos': [
+            {
+                'id': TODO2_GID,
+                'complete': True,
+            },
+        ],
+        'viewer': {
+            'completedCount': 2,
+        },
+        'clientMutationId': 'give_this_back_to_me',
+    }
+}
+
+
+class MarkAllTodosTests(TodoDataTestCase):
+    def test_mark_all_todos(self):
+        result = execute_query(MARK_ALL_TODOS_MUTATION, variable_values=MARK_ALL_TODOS_VARIABLES)
+        self.assertIsNone(result.errors, msg=LazyGraphQLErrors(result.errors))
+        self.assertEqual(result.data, MARK_ALL_TODOS_EXPECTED,
+                         msg=LazyMismatch(MARK_ALL_TODOS_EXPECTED, result.data))
+
+
+REMOVE_COMPLETED_TODOS_MUTATION = parse('''
+  mutation RemoveCompletedTodosMutation($input: RemoveCompletedTodosInput!) {
+    removeCompletedTodos(input: $input) {
+      deletedTodoIds
+      viewer { completedCount totalCount }
+      clientMutationId
+    }
+  }
+''')
+
+REMOVE_COMPLETED_TODOS_VARIABLES = freeze({
+    'input': {
+        'clientMutationId': 'give_this_back_to_me',
+    },
+})
+
+REMOVE_COMPLETED_TODOS_EXPECTED = {
+    'removeCompletedTodos': {
+        'deletedTodoIds': [TODO1_GID],
+        'viewer': {
+            'completedCount': 0,
+            'totalCount': 1,
+        },
+        'clientMutationId': 'give_this_back_to_me',
+    }
+}
+
+
+class RemoveCompletedTodosTests(TodoDataTestCase):
+    def test_remove_todo(self):
+        result = execute_query(REMOVE_COMPLETED_TODOS_MUTATION,
+                               variable_values=REMOVE_COMPLETED_TODOS_VARIABLES)
+        self.assertIsNone(result.errors, msg=LazyGraphQLErrors(result.errors))
+        self.assertEqual(result.data, REMOVE_COMPLETED_TODOS_EXPECTED,
+                         msg=LazyMismatch(REMOVE_COMPLETED_TODOS_EXPECTED, result.data))
+
+
+REMOVE_TODO_MUTATION = parse('''
+  mutation RemoveTodoMutation($input: RemoveTodoInput!) {
+    removeTodo(input: $input) {
+      deletedTodoId
+      viewer { completedCount totalCount }
+      clientMutationId
+    }
+  }
+''')
+
+REMOVE_TODO_VARIABLES = freeze({
+    'input': {
+        'id': TODO1_GID,
+        'clientMutationId': 'give_this_back_to_me',
+    }
+})
+
+REMOVE_TODO_EXPECTED = {
+    'removeTodo': {
+        'deletedTodoId': TODO1_GID,
+        'viewer': {
+            'completedCount': 0,
+            'totalCount': 1,
+        },
+        'clientMutationId': 'give_this_back_to_me',
+    }
+}
+
+
+class RemoveTodoTests(TodoDataTestCase):
+    def test_remove_todo(self):
+        result = execute_query(REMOVE_TODO_MUTATION, variable_values=REMOVE_TODO_VARIABLES)
+        self.assertIsNone(result.errors, msg=LazyGraphQLErrors(result.errors))
+        self.assertEqual(result.data, REMOVE_TODO_EXPECTED,
+                         msg=LazyMismatch(REMOVE_TODO_EXPECTED, result.data))
+
+
+RENAME_TODO_MUTATION = parse('''
+  mutation RenameTodoMutation($input: RenameTodoInput!) {
+    renameTodo(input: $input) {
+      todo { text }
+      clientMutationId
+    }
+  }
+''')
+
+RENAME_TODO_VARIABLES = freeze({
+    'input': {
+        'id': TODO1_GID,
+        'text': 'Taste Python',
+        'clientMutationId': 'give_this_back_to_me',
+    }
+})
+
+RENAME_TODO_EXPECTED = {
+    'renameTodo': {
+        'todo': {
+            'text': 'Taste Python',
+        },
+        'clientMutationId': 'give_this_back_to_me',
+    }
+}
+
+
+class RenameTodoTests(TodoDataTestCase):
     def test_rename_todo(self):
-        create_test_data()
-        query = '''
-          mutation RenameTodoMutation($input: RenameTodoInput!) {
-            renameTodo(input: $input) {
-              todo { text }
-              clientMutationId
-            }
-          }
-        '''
-        variables = {
-            'input': {
-                'id': graphql_relay.to_global_id('Todo', 1),
-                'text': 'Taste Python',
-                'clientMutationId': 'give_this_back_to_me',
-            }
-        }
-        expected = {
-            'renameTodo': {
-                'todo': {
-                    'text': 'Taste Python',
-                },
-                'clientMutationId': 'give_this_back_to_me',
-            }
-        }
-        schema = graphene.Schema(query=Query, mutation=Mutation)
-        result = schema.execute(query, variable_values=variables)
-        self.assertIsNone(result.errors, msg=format_graphql_errors(result.errors))
-        self.assertEqual(result.data, expected, msg='\n'+repr(expected)+'\n'+repr(result.data))
+        result = execute_query(RENAME_TODO_MUTATION, variable_values=RENAME_TODO_VARIABLES)
+        self.assertIsNone(result.errors, msg=LazyGraphQLErrors(result.errors))
+        self.assertEqual(result.data, RENAME_TODO_EXPECTED,
+                         msg=LazyMismatch(RENAME_TODO_EXPECTED, result.data))
+
+    def test_rename_todo_updates_only_text(self):
+        """Test that renaming a todo doesn't rewrite its complete column."""
+        with CaptureQueriesContext(connection) as queries:
+            result = execute_query(RENAME_TODO_MUTATION, variable_values=RENAME_TODO_VARIABLES)
+        self.assertIsNone(result.errors, msg=LazyGraphQLErrors(result.errors))
+        updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertNotIn('"complete"', updates[0])